@@ -1,16 +1,218 @@
 import argparse
-import glob
+import collections
+import concurrent.futures
+import datetime
+import errno
+import json
 import os
 import re
 import sys
 import shutil
+import tempfile
+import threading
 
+import requests
 import tvdb_api
 import configargparse
 
-from fuzzywuzzy import process
+from rapidfuzz import fuzz, process
 
-parser = configargparse.ArgParser(description='Match some shows', default_config_files=['.matcherrc'])
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'showmatcher')
+EPISODE_CACHE_TTL = datetime.timedelta(days=7)
+SERIES_CACHE_FILE = os.path.join(CACHE_DIR, 'series.json')
+
+SIDECAR_EXTENSIONS = ('.srt', '.jpg')
+
+# Filesystems that can't hard link, where moves fall back to check-then-rename
+NO_HARDLINK_ERRNOS = {errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS}
+
+SCORE_CUTOFF = 90
+# WRatio tops out at 60 once one string is more than 8 times longer than the other
+MAX_LENGTH_RATIO = 8
+
+_NORMALISE_RE = re.compile(r"[^\w ]|_")
+_FILENAME_BAD_CHARS = frozenset(':<>/|?*\\')
+_FILENAME_TRANS = str.maketrans(dict.fromkeys(_FILENAME_BAD_CHARS, '-'))
+
+
+def filename_filter(filename):
+    # Most names are already safe, so skip building a new string for them
+    if _FILENAME_BAD_CHARS.isdisjoint(filename):
+        return filename
+
+    return filename.translate(_FILENAME_TRANS)
+
+
+def fast_move(src, dst):
+    # Never overwrites dst; raises FileExistsError instead
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError as e:
+        if e.errno in NO_HARDLINK_ERRNOS:
+            if os.path.exists(dst):
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+            os.replace(src, dst)
+            return
+        elif e.errno != errno.EXDEV:
+            raise
+
+        # Different filesystem: reserve dst, then copy2 uses sendfile where it can
+        os.close(os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        try:
+            shutil.copy2(src, dst)
+        except BaseException:
+            os.unlink(dst)
+            raise
+
+    os.unlink(src)
+
+
+def normalise(tvdb_episode_name):
+    # Collapse the gaps left by removed punctuation so "- Boo Night!" and "Boo Night" agree
+    return ' '.join(_NORMALISE_RE.sub('', tvdb_episode_name.casefold()).split())
+
+
+tvdb = None
+
+
+def tvdb_client():
+    global tvdb
+
+    if tvdb is None:
+        tvdb = tvdb_api.Tvdb()
+
+    return tvdb
+
+
+def read_cache(cache_file):
+    # A missing or corrupt cache file is just a cache miss
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_cache(cache_file, data):
+    # Write to a temporary file alongside and rename it into place, so the cache is never left half written
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    fd, temp_file = tempfile.mkstemp(dir=cache_dir, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_file, cache_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+
+def read_series_ids():
+    series_ids = read_cache(SERIES_CACHE_FILE)
+    return series_ids if isinstance(series_ids, dict) else {}
+
+
+def cached_series_id(series_name):
+    return read_series_ids().get(series_name)
+
+
+def remember_series_id(series_name, series_id):
+    if cached_series_id(series_name) == series_id:
+        return
+
+    # Re-read right before replacing the file so ids other runs have remembered since aren't lost
+    series_ids = read_series_ids()
+    series_ids[series_name] = series_id
+    write_cache(SERIES_CACHE_FILE, series_ids)
+
+
+def fetch_episodes(series):
+    show = tvdb_client()[series]
+
+    if isinstance(series, str):
+        remember_series_id(series, show['id'])
+
+    return show['id'], [dict(episode) for season in show.values() for episode in season.values()]
+
+
+def episode_cache_file(series_id):
+    return os.path.join(CACHE_DIR, 'episodes', u"{:d}.json".format(series_id))
+
+
+def load_or_fetch_episodes(series, refresh=False):
+    # Episodes are cached on disk by series id; a stale cache is still used if TVDB can't be reached.
+    # Returns the episodes and whether they came from a fresh cache without asking TVDB
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    cached = None
+    if isinstance(series, int):
+        cache = read_cache(episode_cache_file(series))
+        try:
+            fetched = datetime.datetime.fromisoformat(cache['fetched'])
+            cached = cache['episodes']
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        if not refresh and cached is not None and now - fetched < EPISODE_CACHE_TTL:
+            return cached, True
+
+    try:
+        series_id, episodes = fetch_episodes(series)
+    except (tvdb_api.tvdb_exception, requests.RequestException):
+        if cached is None:
+            raise
+        print(u"WARNING: Couldn't refresh episodes for {}, using cached copy.".format(series))
+        return cached, False
+
+    write_cache(episode_cache_file(series_id), {'fetched': now.isoformat(), 'episodes': episodes})
+
+    return episodes, False
+
+
+def index_episodes(episodes):
+    # Exact lookup by normalised name, plus parallel (normalised names, episodes) lists per name length
+    normalised_index = {}
+    length_buckets = collections.defaultdict(lambda: ([], []))
+    for episode in episodes:
+        name = normalise(episode['episodeName'] or '')
+        if not name:
+            continue
+
+        normalised_index.setdefault(name, episode)
+
+        bucket_names, bucket_episodes = length_buckets[len(name)]
+        bucket_names.append(name)
+        bucket_episodes.append(episode)
+
+    return normalised_index, length_buckets
+
+
+# Files are matched and moved on a thread pool, so keep each file's output together
+# and stop two files from being moved to the same destination
+print_lock = threading.Lock()
+destination_lock = threading.Lock()
+claimed_destinations = set()
+
+
+def claim_destination(path):
+    with destination_lock:
+        if path in claimed_destinations:
+            return False
+
+        claimed_destinations.add(path)
+        return True
+
+
+# --batch runs each config in turn in this process, sharing the TVDB client
+batch_parser = argparse.ArgumentParser(add_help=False)
+batch_parser.add_argument('--batch', dest='batch', nargs='+', metavar='CONFIG',
+                          help='match each of these config files in turn, in a single run')
+
+parser = configargparse.ArgParser(description='Match some shows', default_config_files=['.matcherrc'],
+                                  parents=[batch_parser])
 
 parser.add('-c', '--config', required=False, is_config_file=True)
 parser.add_argument('--destination', dest='destination', action='store', required=True)
@@ -20,129 +222,235 @@ parser.add_argument('--series-id', dest='series_id', action='store', type=int)
 
 parser.add_argument('--directory', dest='directory', action='store', required=True)
 parser.add_argument('--dry-run', dest='dry_run', default=False, action='store_true')
+parser.add_argument('--refresh', dest='refresh', default=False, action='store_true',
+                    help='refetch episodes from TVDB even if the cached copy is fresh')
 
 ignore_or_series = parser.add_mutually_exclusive_group(required=True)
 ignore_or_series.add_argument('--ignore-substring', dest='ignore', action='store')
 ignore_or_series.add_argument('--naming-pattern', dest='naming_pattern', action='store')
 
-args = parser.parse_args()
 
-tvdb = None
+def match_series(args):
+    file_list = []
+    sidecar_index = collections.defaultdict(list)
 
-file_list = glob.glob(u"{}/*.mp4".format(args.directory))
+    try:
+        with os.scandir(args.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
 
-if not file_list:
-    # print "No episodes for {}".format(args.series)
-    sys.exit(0)
-else:
-    print u"Series {} has episodes".format(args.series)
+                entry_noext, entry_ext = os.path.splitext(entry.name)
+                if entry_ext == '.mp4':
+                    file_list.append((entry.path, entry_noext, entry_ext))
+                elif entry_ext in SIDECAR_EXTENSIONS:
+                    sidecar_index[entry_noext].append((entry.path, entry_ext))
+    except FileNotFoundError:
+        pass
 
-for show_file in file_list:
-    file_noext, ext = os.path.splitext(show_file)
-    basename_noext = os.path.basename(file_noext)
+    if not file_list:
+        # print "No episodes for {}".format(args.series)
+        return
+    else:
+        print(u"Series {} has episodes".format(args.series))
 
-    sidcars = []
-    for sidecar_type in ['srt','jpg']:
-        sidcars += glob.glob(u"{}.{}".format(file_noext, sidecar_type))
+    if args.ignore:
+        if args.series_id is None:
+            args.series_id = cached_series_id(args.series)
+
+        series_key = args.series if args.series_id is None else args.series_id
+        episodes, from_cache = load_or_fetch_episodes(series_key, args.refresh)
+        normalised_index, length_buckets = index_episodes(episodes)
+
+    series_filename = filename_filter(args.series)
+
+    ignore_re = re.compile(args.ignore) if args.ignore else None
+    pattern_re = re.compile(args.naming_pattern) if args.naming_pattern else None
+
+    def dated_episode(groups):
+        if not (groups.get('year') and groups.get('month') and groups.get('day')):
+            return None
+
+        year = int(groups['year'])
+        month = int(groups['month'])
+        day = int(groups['day'])
+
+        return {
+            'episodeName': f"{year:d}-{month:02d}-{day:02d}",
+            'airedSeason': year,
+        }
+
+    def numbered_episode(groups):
+        if not (groups.get('season') and groups.get('episode')):
+            return None
+
+        return {
+            'episodeName': groups.get('name') or '',
+            'airedSeason': int(groups['season']),
+            'airedEpisodeNumber': int(groups['episode']),
+        }
+
+    def any_episode(groups):
+        return dated_episode(groups) or numbered_episode(groups)
+
+    if pattern_re is not None:
+        # Only specialise when the pattern can produce just one of the two forms
+        pattern_groups = pattern_re.groupindex.keys()
+        has_date = {'year', 'month', 'day'} <= pattern_groups
+        has_number = bool({'season', 'episode'} & pattern_groups)
+
+        if has_date and not has_number:
+            episode_from_groups = dated_episode
+        elif has_number and not has_date:
+            episode_from_groups = numbered_episode
+        else:
+            episode_from_groups = any_episode
 
-    def filename_filter(filename):
-        return re.sub('[:<>/|?*\\\\]', '-', filename)
+    def process_file(show_file_entry):
+        output = []
+        report = output.append
 
-    def matching_episode(episode):
-        episode_name = episode['episodeName']
+        show_file, basename_noext, ext = show_file_entry
 
-        if episode_name != '':
-            episode_name = u' {}'.format(episode_name)
+        sidcars = sidecar_index.get(basename_noext, [])
 
-        if 'airedEpisodeNumber' in episode:
-            full_name = u"{} S{:0>2d}E{:0>2d}{}".format(
-                filename_filter(episode['seriesName']),
-                episode['airedSeason'],
-                episode['airedEpisodeNumber'],
-                filename_filter(episode_name),
-                )
-            nice_path = os.path.join(u"Season {:0>2d}".format(episode['airedSeason']), full_name)
-        else:
-            full_name = u"{} -{}".format(
-                episode['seriesName'],
-                filename_filter(episode_name),
+        def matching_episode(episode):
+            episode_name = episode['episodeName']
+
+            if episode_name != '':
+                episode_name = f" {episode_name}"
+
+            season = episode['airedSeason']
+            if 'airedEpisodeNumber' in episode:
+                number = episode['airedEpisodeNumber']
+                full_name = f"{series_filename} S{season:02d}E{number:02d}{filename_filter(episode_name)}"
+                nice_path = os.path.join(f"Season {season:02d}", full_name)
+            else:
+                full_name = f"{series_filename} -{filename_filter(episode_name)}"
+                nice_path = os.path.join(f"Season {season:d}", full_name)
+
+            report(u"Renaming to {}".format(nice_path))
+            new_file_noext = os.path.join(args.destination, nice_path)
+            new_file = new_file_noext + ext
+            if args.dry_run:
+                report(u"Dry run!")
+                return
+            elif not claim_destination(new_file):
+                report(u"WARNING: Couldn't move {}, destination file already exists.".format(show_file))
+                return
+
+            moves = [(show_file, new_file)]
+            moves += [(sidecar, new_file_noext + sidecar_ext) for sidecar, sidecar_ext in sidcars]
+
+            os.makedirs(os.path.dirname(new_file), exist_ok=True)
+            for src, dst in moves:
+                try:
+                    fast_move(src, dst)
+                except FileExistsError:
+                    report(u"WARNING: Couldn't move {}, destination file already exists.".format(src))
+                    if src == show_file:
+                        return
+
+        def episode_find_by_name():
+            episode_name = ignore_re.sub("", basename_noext).strip()
+            report(u"Looking up {} episode \"{}\"".format(args.series, episode_name))
+
+            query = normalise(episode_name)
+            matched = normalised_index.get(query)
+            if matched is None:
+                query_length = len(query)
+                candidate_names = []
+                candidate_episodes = []
+                for length, (bucket_names, bucket_episodes) in length_buckets.items():
+                    if length <= query_length * MAX_LENGTH_RATIO and query_length <= length * MAX_LENGTH_RATIO:
+                        candidate_names += bucket_names
+                        candidate_episodes += bucket_episodes
+
+                fuzzyMatch = process.extractOne(
+                    query=query,
+                    choices=candidate_names,
+                    scorer=fuzz.WRatio,
+                    score_cutoff=SCORE_CUTOFF
                 )
-            nice_path = os.path.join(u"Season {:d}".format(episode['airedSeason']), full_name)
+                if (fuzzyMatch):
+                    matched = candidate_episodes[fuzzyMatch[2]]
+
+            if matched is not None:
+                matching_episode(matched)
+            elif from_cache:
+                # Hold the file back to retry once the episodes have been refetched
+                return False
+            else:
+                report(u"WARNING: No adequate TVDB match found for {}.".format(episode_name))
 
-        print u"Renaming to {}".format(nice_path)
-        new_file = os.path.join(args.destination, u"{}{}".format(nice_path, ext))
-        if args.dry_run:
-            print u"Dry run!"
-            return
-        elif os.path.exists(new_file):
-            print u"WARNING: Couldn't move {}, destination file already exists.".format(show_file)
-        elif not os.path.exists(os.path.dirname(new_file)):
-            print u"WARNING: Couldn't move {}, destination directory does not exist.".format(show_file)
-        else:
-            shutil.move(os.path.join(args.directory, show_file), new_file)
+            return True
 
-            for sidecar in sidcars:
-                new_sidecar = os.path.join(args.destination, u"{}{}".format(nice_path, os.path.splitext(sidecar)[1]))
-                shutil.move(sidecar, new_sidecar)
+        def episode_known_pattern():
+            episode_details = pattern_re.search(basename_noext)
+            episode = episode_from_groups(episode_details.groupdict()) if episode_details is not None else None
 
-    def normalise(tvdb_episode_name):
-        return re.sub(r"[^0-9a-z ]", '', tvdb_episode_name.lower())
+            if episode is not None:
+                matching_episode(episode)
+            else:
+                report(u"WARNING: No pattern match for {}.".format(basename_noext))
 
-    def episode_find_by_name():
-        global tvdb
+        handled = True
+        try:
+            if args.ignore:
+                handled = episode_find_by_name()
+            else:
+                episode_known_pattern()
+        finally:
+            if handled:
+                with print_lock:
+                    print(u"\n".join(output))
 
-        if tvdb is None:
-            tvdb = tvdb_api.Tvdb()
+        return handled
 
-        show = tvdb[args.series if args.series_id is None else args.series_id]
+    def process_files(entries):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            return list(executor.map(process_file, entries))
 
-        episode_name = re.compile(args.ignore).sub("", basename_noext).strip()
-        print u"Looking up {} episode \"{}\"".format(args.series, episode_name)
+    handled = process_files(file_list)
 
-        fuzzyMatch = process.extractOne(
-            query=episode_name,
-            choices={episode['id']: episode['episodeName'] for season in show.values() for episode in season.values()},
-            score_cutoff=90
-        )
-        if (fuzzyMatch):
-            episode = show.search(fuzzyMatch[2], 'id')[0]
-            episode['seriesName'] = args.series
+    # A cached episode list can predate newly aired episodes, so refetch once and retry any misses
+    missed = [entry for entry, entry_handled in zip(file_list, handled) if not entry_handled]
+    if missed:
+        print(u"Refreshing {} episodes from TVDB".format(args.series))
+        episodes, _ = load_or_fetch_episodes(series_key, refresh=True)
+        normalised_index, length_buckets = index_episodes(episodes)
+        from_cache = False
 
-            matching_episode(episode)
-        else:
-            print u"WARNING: No adequate TVDB match found for {}.".format(episode_name)
+        process_files(missed)
 
-    def episode_known_pattern():
-        episode_details = re.compile(args.naming_pattern).search(basename_noext)
 
-        try:
-            if 'year' in args.naming_pattern:
-                year = int(episode_details.group('year'))
-                month = int(episode_details.group('month'))
-                day = int(episode_details.group('day'))
-
-                label = u"{:d}-{:0>2d}-{:0>2d}".format(year, month, day)
-
-                matching_episode({
-                    'episodeName': label,
-                    'airedSeason': year,
-                    'seriesName': args.series,
-                })
-            else:
-                season = int(episode_details.group('season'))
-                episode = int(episode_details.group('episode'))
-                name = episode_details.group('name')
-
-                matching_episode({
-                    'episodeName': name,
-                    'seriesName': args.series,
-                    'airedSeason': season,
-                    'airedEpisodeNumber': episode,
-                })
-        except:
-            print u"WARNING: No pattern match for {}.".format(basename_noext)
+def main(argv):
+    batch_args, argv = batch_parser.parse_known_args(argv)
 
-    if args.ignore:
-        episode_find_by_name()
-    else:
-        episode_known_pattern()
+    if not batch_args.batch:
+        match_series(parser.parse_args(argv))
+        return 0
+
+    # One bad config shouldn't stop the rest of the batch
+    failed = False
+    for config in batch_args.batch:
+        try:
+            match_series(parser.parse_args(argv + ['--config', config]))
+        except SystemExit as e:
+            if not e.code:
+                raise
+            print(u"WARNING: Couldn't read config {}, skipping it.".format(config))
+            failed = True
+        # requests' exceptions are OSErrors too, so network failures have to be caught first
+        except (tvdb_api.tvdb_exception, requests.RequestException) as e:
+            print(u"WARNING: Couldn't look up {} on TVDB: {}".format(config, e))
+            failed = True
+        except OSError as e:
+            print(u"WARNING: Filesystem error while matching {}: {}".format(config, e))
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))